@@ -4,6 +4,9 @@ from typing import Any, Dict, List
 import os
 import requests
 
+# reuse the connection to the Slack notifications service, its only call is a POST which is not retried
+_SESSION = requests.Session()
+
 
 class Notifier:
     def __init__(self, *channels: str, display: str, emoji: str):
@@ -15,6 +18,7 @@ class Notifier:
             os.getenv("SLACK_NOTIFICATION_URL")
             or "https://slack-notifications.tax.service.gov.uk/slack-notifications/v2/notification"
         )
+        self._headers = self._build_headers()
 
     def send_message(self, text: str, blocks: List[Dict[str, Any]]) -> None:
         try:
@@ -26,9 +30,9 @@ class Notifier:
         raise MissingConfigException(config)
 
     def _send(self, text: str, blocks: List[Dict[str, Any]]) -> Dict[str, Any]:
-        response = requests.post(
+        response = _SESSION.post(
             url=self._url,
-            headers=self._build_headers(),
+            headers=self._headers,
             json=self._build_payload(text, blocks),
             timeout=10,
         )
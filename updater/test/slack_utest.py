@@ -6,7 +6,7 @@ import httpretty
 import json
 import os
 
-from updater import slack
+import slack
 
 
 class TestMissingConfig(TestCase):
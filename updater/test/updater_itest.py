@@ -1,46 +1,116 @@
+import glob
 import json
 import os
-import random
 import requests
 import shutil
 import subprocess
-import sys
 import tempfile
-import time
+import threading
 import unittest
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, List, Optional
+from unittest.mock import patch
 
 from updater import main
 
+# keep connections to the Gitea server alive across requests and tests
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+class XMLResourcesHandler(BaseHTTPRequestHandler):
+    """Serves the input ZAP versions XML test resources from memory"""
+
+    resources: Dict[str, bytes] = {}
+
+    @classmethod
+    def load(cls, resources_dir: str) -> None:
+        for resource in glob.glob(os.path.join(resources_dir, "*.input.xml")):
+            with open(resource, "rb") as resource_file:
+                cls.resources[f"/test/resources/{os.path.basename(resource)}"] = resource_file.read()
+
+    def do_GET(self) -> None:
+        body = self.resources.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 
 class TestMain(unittest.TestCase):
     maxDiff = None
-    web_server_port = random.randint(10000, 65535)
-    # start web server in background
-    web_server = subprocess.Popen(
-        args=[
-            f"{sys.executable}",  # absolute path to python
-            "-m",
-            "http.server",
-            "--bind",
-            "localhost",
-            f"{web_server_port}",
-        ],
-    )
     main_directory = os.getcwd()
+    # set once in setUpClass
+    git_api_fork_url: str
+    git_api_pr_url: str
+    git_pr_url: str
+    slack_host: str
+    fork_owner: str
+    fork_parent_owner: str
+    web_server: ThreadingHTTPServer
+    web_server_port: int
+    template_directory: str
 
     @classmethod
     def setUpClass(cls) -> None:
-        os.environ["GIT_HMRC_USER_API_TOKEN"] = get_git_hmrc_user_token()
-        os.environ["GITHUB_API_TOKEN"] = get_git_readonly_user_token()
-        # give web_server time to boot up
-        time.sleep(0.5)
+        # the git identity and tokens the tests put in the environment are dropped once the class is done, so they
+        # do not leak into tests that run later in the same process
+        environ = patch.dict(os.environ)
+        environ.start()
+        cls.addClassCleanup(environ.stop)
+        # where the updater results are checked, these do not change during the run
+        cls.git_api_fork_url = os.environ["GIT_API_FORK_URL"]
+        cls.git_api_pr_url = os.environ["GIT_API_PR_URL"]
+        cls.git_pr_url = os.environ["GIT_PR_URL"]
+        cls.slack_host = os.environ["SLACK_HOST"]
+        cls.fork_owner = os.environ["GITHUB_API_USER"]
+        cls.fork_parent_owner = os.environ["GIT_HMRC_USER"]
+        # serve test resources from a background thread, the server socket is
+        # bound to a free port and listening as soon as the server is created
+        XMLResourcesHandler.load(os.path.join(cls.main_directory, "test", "resources"))
+        cls.web_server = ThreadingHTTPServer(("localhost", 0), XMLResourcesHandler)
+        cls.web_server_port = cls.web_server.server_address[1]
+        threading.Thread(target=cls.web_server.serve_forever, daemon=True).start()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            hmrc_user_token = executor.submit(get_git_hmrc_user_token)
+            readonly_user_token = executor.submit(get_git_readonly_user_token)
+            os.environ["GIT_HMRC_USER_API_TOKEN"] = hmrc_user_token.result()
+            os.environ["GITHUB_API_TOKEN"] = readonly_user_token.result()
+        run_command(
+            ["git", "config", "--global", "credential.helper", "store"], "Could not configure git credential helper"
+        )
+        # copy the repository once, every test then hard links this copy
+        cls.template_directory = tempfile.mkdtemp()
+        shutil.copytree(
+            os.path.abspath(os.path.join(cls.main_directory, os.pardir)),
+            os.path.join(cls.template_directory, "build-dynamic-application-security-testing"),
+            ignore=shutil.ignore_patterns(".git"),
+        )
 
     def setUp(self) -> None:
-        self.test_directory = tempfile.mkdtemp()
+        self.tid = unittest.TestCase.id(self)
+        # removed after tearDown, and also when setUp fails half way through
+        test_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(test_directory.cleanup)
+        self.test_directory = test_directory.name
+        self.repo_dir = os.path.join(self.test_directory, "build-dynamic-application-security-testing")
+        self.resources_dir = os.path.join(self.repo_dir, "updater", "test", "resources")
+        self.addons_path = f"{self.resources_dir}/{self.tid}.input.zap_addons"
+        self.dockerfile_path = f"{self.repo_dir}/Dockerfile"
+        self.xml_url = f"http://localhost:{self.web_server_port}/test/resources/{self.tid}.input.xml"
+        # the updater clones the fork into the current directory unless told otherwise
+        fork_dir = patch.dict(os.environ, {"GIT_FORK_DIR": os.path.join(self.test_directory, "fork")})
+        fork_dir.start()
+        self.addCleanup(fork_dir.stop)
         copy_repo_to_test_dir(self)
-        os.chdir(os.path.join(self.test_directory, "build-dynamic-application-security-testing"))
-        configure_git()
+        configure_git(self.repo_dir)
 
     def setUpEnv(self, git_pr_title: str) -> None:
         self.original_pr_title = os.getenv("GIT_PR_TITLE")
@@ -52,20 +122,17 @@ class TestMain(unittest.TestCase):
         """
         Exercise complete flow for four usual addons if we call main function.
         """
-        want_pr_title = unittest.TestCase.id(self)
+        want_pr_title = self.tid
         self.setUpEnv(git_pr_title=want_pr_title)
 
-        addons_path = f"{os.getcwd()}/updater/test/resources/{unittest.TestCase.id(self)}.input.zap_addons"
-        dockerfile_path = f"{os.getcwd()}/Dockerfile"
-        xml_url = f"http://localhost:{self.web_server_port}/test/resources/{unittest.TestCase.id(self)}.input.xml"
-
-        main(addons_path, dockerfile_path, xml_url, True)
+        main(self.addons_path, self.dockerfile_path, self.xml_url, True)
 
-        assert_repo_has_fork(self)
-        assert_pull_request_is_from_fork(self)
-        assert_pull_request_diff_equal(self)
+        results = fetch_updater_results(self, pull_request_diff=True)
+        assert_repo_has_fork(self, results["forks"].json())
+        assert_pull_request_is_from_fork(self, results["pulls"].json())
+        assert_pull_request_diff_equal(self, results["diff"].text)
         self.assertTrue(
-            slack_notification_sent(want_pr_title),
+            slack_notification_sent(results["notifications"].json()["requests"], want_pr_title),
             f"Expected Slack notification sent with title '{want_pr_title}' in message attachments",
         )
 
@@ -73,19 +140,16 @@ class TestMain(unittest.TestCase):
         """
         No pull request is created when no changes are made in the Dockerfile.
         """
-        want_pr_title = unittest.TestCase.id(self)
+        want_pr_title = self.tid
         self.setUpEnv(git_pr_title=want_pr_title)
 
-        addons_path = f"{os.getcwd()}/updater/test/resources/{unittest.TestCase.id(self)}.input.zap_addons"
-        dockerfile_path = f"{os.getcwd()}/Dockerfile"
-        xml_url = f"http://localhost:{self.web_server_port}/test/resources/{unittest.TestCase.id(self)}.input.xml"
+        main(self.addons_path, self.dockerfile_path, self.xml_url, True)
 
-        main(addons_path, dockerfile_path, xml_url, True)
-
-        assert_repo_has_no_fork(self)
-        assert_no_pull_request(self)
+        results = fetch_updater_results(self, pull_request_diff=False)
+        assert_repo_has_no_fork(self, results["forks"].json())
+        assert_no_pull_request(self, results["pulls"].json())
         self.assertFalse(
-            slack_notification_sent(want_pr_title),
+            slack_notification_sent(results["notifications"].json()["requests"], want_pr_title),
             f"Expected no Slack notification sent with title '{want_pr_title}' in message attachments",
         )
 
@@ -93,49 +157,49 @@ class TestMain(unittest.TestCase):
         """
         Exercise complete flow for four usual addons if we call executable with arguments.
         """
-        want_pr_title = unittest.TestCase.id(self)
+        want_pr_title = self.tid
         self.setUpEnv(git_pr_title=want_pr_title)
 
-        addons_path = f"{os.getcwd()}/updater/test/resources/{unittest.TestCase.id(self)}.input.zap_addons"
-        dockerfile_path = f"{os.getcwd()}/Dockerfile"
-        xml_url = f"http://localhost:{self.web_server_port}/test/resources/{unittest.TestCase.id(self)}.input.xml"
-
         result = subprocess.run(
             args=[
                 f"{self.main_directory}/updater.py",
                 "--addons",
-                addons_path,
+                self.addons_path,
                 "--dockerfile",
-                dockerfile_path,
+                self.dockerfile_path,
                 "--url",
-                xml_url,
-            ]
+                self.xml_url,
+                "--cache",
+                os.path.join(self.test_directory, ".zap_versions.xml"),
+            ],
+            cwd=self.repo_dir,
         )
 
         self.assertEqual(result.returncode, 0, "Expected the updater script to exit without error code")
 
-        assert_repo_has_fork(self)
-        assert_pull_request_is_from_fork(self)
-        assert_pull_request_diff_equal(self)
+        results = fetch_updater_results(self, pull_request_diff=True)
+        assert_repo_has_fork(self, results["forks"].json())
+        assert_pull_request_is_from_fork(self, results["pulls"].json())
+        assert_pull_request_diff_equal(self, results["diff"].text)
         self.assertTrue(
-            slack_notification_sent(want_pr_title),
+            slack_notification_sent(results["notifications"].json()["requests"], want_pr_title),
             f"Expected Slack notification sent with title '{want_pr_title}' in message attachments",
         )
 
     def tearDown(self) -> None:
         delete_git_fork_and_repository()
-        os.chdir(self.main_directory)
-        shutil.rmtree(self.test_directory)
         if self.original_pr_title is not None:
             os.environ["GIT_PR_TITLE"] = self.original_pr_title
 
     @classmethod
     def tearDownClass(cls) -> None:
-        # terminate web server and wait until it is done
-        cls.web_server.terminate()
-        cls.web_server.wait()
-        run_command("make stop-git-server", "Could not stop git server")
-        run_command("make stop-slack-service-stub", "Could not stop Slack server stub")
+        # stop web server and wait until it is done
+        cls.web_server.shutdown()
+        cls.web_server.server_close()
+        shutil.rmtree(cls.template_directory)
+        _SESSION.close()
+        run_command(["make", "stop-git-server"], "Could not stop git server")
+        run_command(["make", "stop-slack-service-stub"], "Could not stop Slack server stub")
 
 
 def get_git_hmrc_user_token() -> str:
@@ -149,7 +213,7 @@ def get_git_readonly_user_token() -> str:
 def get_git_token(user: str) -> str:
     basic_credentials = b64encode(f"{user}:{user}".encode("utf-8")).decode("utf-8")
     return str(
-        requests.post(
+        _SESSION.post(
             url=f"http://{os.getenv('GIT_HOST')}/api/v1/users/{user}/tokens",
             headers={
                 "Content-Type": "application/json",
@@ -162,113 +226,135 @@ def get_git_token(user: str) -> str:
 
 
 def update_file(test: TestMain, kind: str, extension: str, content: str) -> None:
-    target_file = f"{test.main_directory}/test/resources/{unittest.TestCase.id(test)}.{kind}.{extension}"
+    target_file = f"{test.main_directory}/test/resources/{test.tid}.{kind}.{extension}"
     print(f"Updating {kind} file: {target_file}")
     with open(target_file, "w") as test_file:
         test_file.write(content)
 
 
 def load_file(test: TestMain, kind: str, extension: str) -> str:
-    with open(f"{os.getcwd()}/updater/test/resources/{unittest.TestCase.id(test)}.{kind}.{extension}") as target_file:
+    with open(f"{test.main_directory}/test/resources/{test.tid}.{kind}.{extension}") as target_file:
         return target_file.read()
 
 
-def assert_repo_has_fork(self: TestMain) -> None:
-    forks = requests.get(url=os.environ["GIT_API_FORK_URL"]).json()
+def fetch_updater_results(test: TestMain, pull_request_diff: bool) -> Dict[str, requests.Response]:
+    """
+    Fetch the forks, pull requests, pull request diff and Slack notifications
+    left by the updater. They are independent, so they are requested at once.
+    """
+    urls = {
+        "forks": test.git_api_fork_url,
+        "pulls": test.git_api_pr_url,
+        "notifications": f"http://{test.slack_host}/__admin/requests",
+    }
+    if pull_request_diff:
+        urls["diff"] = f"{test.git_pr_url}/1.diff"
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        responses = {name: executor.submit(_SESSION.get, url) for name, url in urls.items()}
+        return {name: response.result() for name, response in responses.items()}
+
+
+def assert_repo_has_fork(self: TestMain, forks: List[Dict[str, Any]]) -> None:
     self.assertEqual(len(forks), 1, f"expected to find one fork but found {len(forks)}")
 
     fork_owner = forks[0]["owner"]["username"]
-    self.assertEqual(fork_owner, os.getenv("GITHUB_API_USER"))
+    self.assertEqual(fork_owner, self.fork_owner)
 
     fork_parent = forks[0]["parent"]["owner"]["username"]
-    self.assertEqual(fork_parent, os.getenv("GIT_HMRC_USER"))
+    self.assertEqual(fork_parent, self.fork_parent_owner)
 
 
-def assert_repo_has_no_fork(self: TestMain) -> None:
-    forks = requests.get(url=os.environ["GIT_API_FORK_URL"]).json()
+def assert_repo_has_no_fork(self: TestMain, forks: List[Dict[str, Any]]) -> None:
     self.assertEqual(len(forks), 0, f"expected no fork but found {len(forks)}")
 
 
-def assert_pull_request_is_from_fork(self: TestMain) -> None:
-    pulls = requests.get(url=os.environ["GIT_API_PR_URL"]).json()
+def assert_pull_request_is_from_fork(self: TestMain, pulls: List[Dict[str, Any]]) -> None:
     self.assertEqual(len(pulls), 1, f"expected to find one pull request but found {len(pulls)}")
 
     is_fork = pulls[0]["head"]["repo"]["fork"]
     self.assertTrue(is_fork, "expected the pull request to come from a fork but it doesn't")
 
 
-def assert_pull_request_diff_equal(self: TestMain) -> None:
-    got_diff = requests.get(f"{os.getenv('GIT_PR_URL')}/1.diff").text
+def assert_pull_request_diff_equal(self: TestMain, got_diff: str) -> None:
     if os.getenv("UPDATE_GOLDEN_FILES"):
         update_file(self, "golden", "diff", got_diff)
-        shutil.copyfile(
-            f"{self.main_directory}/test/resources/{unittest.TestCase.id(self)}.golden.diff",
-            f"{self.test_directory}/{unittest.TestCase.id(self)}.golden.diff",
-        )
 
     self.assertEqual(got_diff.strip(), load_file(self, "golden", "diff").strip())
 
 
-def assert_no_pull_request(self: TestMain) -> None:
-    pull_requests = requests.get(url=os.environ["GIT_API_PR_URL"]).json()
+def assert_no_pull_request(self: TestMain, pull_requests: List[Dict[str, Any]]) -> None:
     self.assertEqual(len(pull_requests), 0, "Expected no pull requests to be raised")
 
 
-def slack_notification_sent(want_pr_title: str) -> bool:
-    notifications = requests.get(f"http://{os.getenv('SLACK_HOST')}/__admin/requests").json()["requests"]
-
+def slack_notification_sent(notifications: List[Dict[str, Any]], want_pr_title: str) -> bool:
     for notification in notifications:
-        blocks = json.loads(notification["request"]["body"])["blocks"]
+        body = notification["request"]["body"]
+        # only parse the notifications that mention the title somewhere
+        if want_pr_title not in body:
+            continue
+        blocks = json.loads(body)["blocks"]
         if want_pr_title in str(blocks):
             return True
     return False
 
 
 def copy_repo_to_test_dir(test: TestMain) -> None:
-    path = os.getcwd()
-    rp = os.path.abspath(os.path.join(path, os.pardir))
-
-    shutil.copytree(rp, os.path.join(test.test_directory, "build-dynamic-application-security-testing"))
-    shutil.copy2(
-        f"{test.main_directory}/test/resources/{unittest.TestCase.id(test)}.input.Dockerfile",
-        os.path.join(test.test_directory, "build-dynamic-application-security-testing", "Dockerfile"),
+    shutil.copytree(
+        os.path.join(test.template_directory, "build-dynamic-application-security-testing"),
+        test.repo_dir,
+        copy_function=os.link,
     )
+    # the updater rewrites the Dockerfile in place, unlink it first so the template keeps its own copy
+    os.unlink(test.dockerfile_path)
+    shutil.copy2(f"{test.main_directory}/test/resources/{test.tid}.input.Dockerfile", test.dockerfile_path)
 
 
 def configure_git_user(user: str, token: str) -> None:
     with open(f"{os.getenv('HOME')}/.git-credentials", "w") as file:
         file.write(f"http://{user}:{token}@{os.getenv('GIT_HOST')}")
 
-    run_command("git config --global credential.helper store", "Could not configure git credential helper")
-    run_command(f"git config --global user.name '{user}'", "Could not configure git user name")
-    run_command(f"git config --global user.email '{user}'", "Could not configure git user email")
+    # git and the updater's git commands read the committer from the environment, no git config process needed
+    for identity in ("GIT_AUTHOR_NAME", "GIT_AUTHOR_EMAIL", "GIT_COMMITTER_NAME", "GIT_COMMITTER_EMAIL"):
+        os.environ[identity] = user
 
 
-def configure_git() -> None:
+def configure_git(repo_dir: str) -> None:
     configure_git_user(os.environ["GIT_HMRC_USER"], os.environ["GIT_HMRC_USER_API_TOKEN"])
-    requests.post(
-        url=f"http://{os.environ['GIT_HOST']}/api/v1/user/repos",
-        headers={
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "authorization": f"token {os.getenv('GIT_HMRC_USER_API_TOKEN')}",
-        },
-        json={"default_branch": "main", "name": "build-dynamic-application-security-testing"},
-    )
-    run_command("git init --initial-branch main", "Could not initialise git repository")
-    run_command(
-        f"git remote add origin http://{os.getenv('GIT_HOST')}/{os.getenv('GIT_HMRC_USER')}/build-dynamic-application-security-testing.git",
-        "Could not add git origin",
-    )
-    run_command("git stage .", "Could not stage files")
-    run_command("git commit --message 'Initial commit'", "Could not make initial commit")
-    run_command("git push --set-upstream origin main", "Could not push initial commit")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # create the remote repository while the local one is committed, it is only needed by the push
+        create_repository = executor.submit(
+            _SESSION.post,
+            url=f"http://{os.environ['GIT_HOST']}/api/v1/user/repos",
+            headers={
+                "accept": "application/json",
+                "Content-Type": "application/json",
+                "authorization": f"token {os.getenv('GIT_HMRC_USER_API_TOKEN')}",
+            },
+            json={"default_branch": "main", "name": "build-dynamic-application-security-testing"},
+        )
+        run_command(["git", "init", "--initial-branch", "main"], "Could not initialise git repository", repo_dir)
+        run_command(
+            [
+                "git",
+                "remote",
+                "add",
+                "origin",
+                f"http://{os.getenv('GIT_HOST')}/{os.getenv('GIT_HMRC_USER')}/build-dynamic-application-security-testing.git",
+            ],
+            "Could not add git origin",
+            repo_dir,
+        )
+        run_command(["git", "stage", "."], "Could not stage files", repo_dir)
+        run_command(["git", "commit", "--message", "Initial commit"], "Could not make initial commit", repo_dir)
+        create_repository.result()
+    run_command(["git", "push", "--set-upstream", "origin", "main"], "Could not push initial commit", repo_dir)
 
     configure_git_user(os.environ["GITHUB_API_USER"], os.environ["GITHUB_API_TOKEN"])
 
 
 def delete_git_fork_and_repository() -> None:
-    requests.delete(
+    _SESSION.delete(
         url=f"http://{os.getenv('GIT_HOST')}/api/v1/repos/{os.getenv('GITHUB_API_USER')}/build-dynamic-application-security-testing",
         headers={
             "accept": "application/json",
@@ -276,7 +362,7 @@ def delete_git_fork_and_repository() -> None:
             "authorization": f"token {os.getenv('GITHUB_API_TOKEN')}",
         },
     )
-    requests.delete(
+    _SESSION.delete(
         url=f"http://{os.getenv('GIT_HOST')}/api/v1/repos/{os.getenv('GIT_HMRC_USER')}/build-dynamic-application-security-testing",
         headers={
             "accept": "application/json",
@@ -286,8 +372,14 @@ def delete_git_fork_and_repository() -> None:
     )
 
 
-def run_command(cmd: str, err: str) -> None:
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
+# fail instead of waiting for credentials, and skip git's optional index refreshes and background gc
+GIT_ENV = {"GIT_TERMINAL_PROMPT": "0", "GIT_OPTIONAL_LOCKS": "0", "GIT_CONFIG_PARAMETERS": "'gc.auto=0'"}
+
+
+def run_command(args: List[str], err: str, cwd: Optional[str] = None) -> None:
+    proc = subprocess.run(
+        args=args, cwd=cwd, env={**os.environ, **GIT_ENV}, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
     if proc.returncode != 0:
         raise SystemExit(f"{err}: {proc.stdout.decode('utf-8')}")
 